@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import sys
-from itertools import zip_longest
 
 from .currency_converter import CurrencyConverter, CURRENCY_FILE, parse_date
 from ._version import __version__
@@ -16,7 +15,9 @@ def grouper(iterable, n, fillvalue=None):
     def
     gxx
     """
-    return list(zip_longest(*[iter(iterable)] * n, fillvalue=fillvalue))
+    items = list(iterable)
+    items += [fillvalue] * (-len(items) % n)
+    return [items[i : i + n] for i in range(0, len(items), n)]
 
 
 def main():
@@ -69,6 +70,12 @@ def main():
         default=CURRENCY_FILE,
     )
 
+    parser.add_argument(
+        "--cache",
+        help="cache the parsed currency file next to it, to speed up later calls",
+        action="store_true",
+    )
+
     args = parser.parse_args()
 
     c = CurrencyConverter(
@@ -77,10 +84,10 @@ def main():
         fallback_on_missing_rate=True,
         decimal=args.decimal,
         verbose=args.verbose > 1,
+        cache=args.cache,
     )
-    currencies = sorted(c.currencies)
-
     if args.verbose:
+        currencies = sorted(c.currencies)
         print(f"{len(currencies)} available currencies:")
         for group in grouper(currencies, 10, fillvalue=""):
             print(" ".join(group))
@@ -99,7 +106,7 @@ def main():
     for currency in (args.currency, args.to):
         if currency not in c.currencies:
             print(rf'/!\ "{currency}" is not in available currencies:')
-            for group in grouper(currencies, 10, fillvalue=""):
+            for group in grouper(sorted(c.currencies), 10, fillvalue=""):
                 print(" ".join(group))
             return 1
 
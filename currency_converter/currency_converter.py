@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 
+import os
 import os.path as op
-from functools import wraps
+import sys
+import pickle
+import warnings
+import csv
+from functools import lru_cache
 import datetime
 from datetime import timedelta
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from zipfile import ZipFile
-from io import BytesIO
-from decimal import Decimal
+from shutil import copyfileobj
+from io import BytesIO, TextIOWrapper
+from itertools import islice, repeat, zip_longest
+from decimal import Decimal, getcontext
 from urllib.request import urlopen
 
 _DIRNAME = op.realpath(op.dirname(__file__))
@@ -18,6 +25,11 @@ SINGLE_DAY_ECB_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref.zip"
 
 Bounds = namedtuple("Bounds", "first_date last_date")
 
+_MISSING = object()  # fill value of convert_batch inputs of different lengths
+
+# Bump when the layout of parsed rates changes, to invalidate cache files
+_CACHE_VERSION = 2
+
 __all__ = [
     "CurrencyConverter",
     "S3CurrencyConverter",
@@ -29,39 +41,35 @@ __all__ = [
 ]
 
 
-def memoize(function):
-    memo = {}
-
-    @wraps(function)
-    def wrapper(*args):
-        if args not in memo:
-            memo[args] = function(*args)
-        return memo[args]
-
-    return wrapper
-
-
-@memoize
-def list_dates_between(first_date, last_date):
-    """Returns all dates from first to last included."""
-    return [
-        first_date + timedelta(days=n) for n in range(1 + (last_date - first_date).days)
-    ]
-
-
-@memoize
+@lru_cache(maxsize=1 << 16)
 def parse_date(s):
     """Fast %Y-%m-%d parsing."""
-    try:
-        return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:10]))
-    except ValueError:  # other accepted format used in one-day data set
-        return datetime.datetime.strptime(s, "%d %B %Y").date()
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        return datetime.date.fromisoformat(s)  # done in C
+    # other accepted format used in one-day data set
+    return datetime.datetime.strptime(s, "%d %B %Y").date()
 
 
-def get_lines_from_zip(zip_str):
-    zip_file = ZipFile(BytesIO(zip_str))
+def get_lines_from_zip(zip_file):
+    zip_file = ZipFile(zip_file)
     for name in zip_file.namelist():
-        yield from zip_file.read(name).decode("utf-8").splitlines()
+        # Decode and split lines while streaming, the C I/O layer does it in bulk
+        with TextIOWrapper(zip_file.open(name), encoding="utf-8", newline="") as f:
+            yield from f
+
+
+def _iter_gaps(rates, first_idx, last_idx):
+    """Yields the start and stop indexes of each run of missing rates.
+
+    Rates at the bounds are never missing, so every gap is between two
+    available rates.
+    """
+    prev_idx = first_idx
+    for i, rate in enumerate(rates[first_idx + 1 : last_idx + 1], first_idx + 1):
+        if rate is not None:
+            if i - prev_idx > 1:
+                yield prev_idx + 1, i
+            prev_idx = i
 
 
 class RateNotFoundError(Exception):
@@ -82,7 +90,11 @@ class CurrencyConverter:
     ``_rates`` is a dictionary with:
 
     - currencies as keys
-    - {date: rate, ...} as values.
+    - [rate, ...] as values, where the rate at index ``i`` is the one of day
+      ``_epoch + i``, and ``None`` marks a missing rate.
+
+    All rate lists share the same ``_epoch`` (the first date of the data) and
+    the same length, so a date is turned into an index only once.
 
     ``currencies`` is a set of all available currencies.
     ``bounds`` is a dict if first and last date available per currency.
@@ -98,6 +110,7 @@ class CurrencyConverter:
         na_values=frozenset(["", "N/A"]),
         decimal=False,
         verbose=False,
+        cache=False,
     ):
         """Instantiate a CurrencyConverter.
 
@@ -123,20 +136,35 @@ class CurrencyConverter:
         :param iterable na_values: What to interpret as missing values in the
             source data.
         :param decimal: Set to True to use decimal.Decimal internally, this will
-            slow the loading time but will allow exact conversions
+            slow the loading time but will allow exact conversions. Values are
+            created with the decimal context current at instantiation.
         :param verbose: Set to True to print what is going on under the hood.
+        :param cache: Set to True to keep the parsed rates of a local
+            currency_file in a pickle file next to it, with an added '.pickle'
+            extension, and to load them from there as long as the source file
+            is unchanged. This speeds up repeated short-lived instantiations,
+            such as command line calls. The directory of currency_file must be
+            trusted, as loading a pickle file can run arbitrary code.
         """
         # Global options
         self.fallback_on_wrong_date = fallback_on_wrong_date
         self.fallback_on_missing_rate = fallback_on_missing_rate
         self.fallback_on_missing_rate_method = fallback_on_missing_rate_method
-        self.ref_currency = ref_currency  # reference currency of rates
+        self.ref_currency = sys.intern(ref_currency)  # reference currency of rates
         self.na_values = na_values  # missing values
         self.cast = Decimal if decimal else float
+        # create_decimal of the current context parses rates faster than
+        # Decimal, but rejects padded strings, so amounts still use cast
+        self._parse_rate = getcontext().create_decimal if decimal else float
+        self._one = self.cast("1")  # rate of the reference currency
         self.verbose = verbose
+        self.cache = cache
 
         # Will be filled once the file is loaded
         self._rates = None
+        self._epoch = None
+        self._indices = None
+        self._unfilled = set()  # currencies whose missing rates are not filled yet
         self.bounds = None
         self.currencies = None
 
@@ -145,132 +173,238 @@ class CurrencyConverter:
 
     def load_file(self, currency_file):
         """To be subclassed if alternate methods of loading data."""
+        if self.cache and not currency_file.startswith(("http://", "https://")):
+            cache_file = currency_file + ".pickle"
+            key = self._get_cache_key(currency_file)
+            if self._read_cache(cache_file, key):
+                self._prepare_rates()
+                self._fill_missing_rates()
+            else:
+                self._parse_file(currency_file)
+                self._write_cache(cache_file, key)
+        else:
+            self._parse_file(currency_file)
+
+    def _get_cache_key(self, currency_file):
+        """Returns what the cached rates of a file depend on."""
+        stat = os.stat(currency_file)
+        return (
+            _CACHE_VERSION,
+            stat.st_mtime_ns,
+            stat.st_size,
+            sorted(self.na_values),
+            self._get_decimal_context_key(),
+        )
+
+    def _get_decimal_context_key(self):
+        """Returns what decimal rates depend on, None when using floats."""
+        if self._parse_rate is float:
+            return None
+        context = self._parse_rate.__self__  # the context of create_decimal
+        return context.prec, context.rounding
+
+    def _read_cache(self, cache_file, key):
+        """Load the rates from a cache file, if it matches the key."""
+        try:
+            with open(cache_file, "rb") as f:
+                cached_key, epoch, rates, indices = pickle.load(f)
+        except (
+            OSError,
+            EOFError,
+            ValueError,
+            TypeError,  # not a tuple, e.g. a foreign pickle
+            AttributeError,  # unpickling unknown classes
+            ImportError,
+            pickle.UnpicklingError,
+        ):
+            return False
+        if cached_key != key:
+            return False
+
+        # Unpickled strings are not interned anymore
+        self._epoch = epoch
+        self._rates = {sys.intern(c): r for c, r in rates.items()}
+        self._indices = {sys.intern(c): i for c, i in indices.items()}
+        return True
+
+    def _write_cache(self, cache_file, key):
+        """Save the rates to a cache file, if possible."""
+        data = key, self._epoch, self._rates, self._indices
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)  # atomic for concurrent readers
+        except OSError as e:  # e.g. read-only directory, the cache is optional
+            warnings.warn(f"Could not write cache file {cache_file}: {e}")
+            try:
+                os.remove(tmp_file)
+            except OSError:  # never created
+                pass
+
+    def _parse_file(self, currency_file):
         if currency_file.startswith(("http://", "https://")):
-            content = urlopen(currency_file).read()
+            f = BytesIO()
+            with urlopen(currency_file) as response:
+                copyfileobj(response, f, 1 << 16)
+            f.seek(0)
         else:
-            with open(currency_file, "rb") as f:
-                content = f.read()
+            f = open(currency_file, "rb")
 
         if currency_file.endswith(".zip"):
-            self.load_lines(get_lines_from_zip(content))
+            with f:
+                self.load_lines(get_lines_from_zip(f))
         else:
-            self.load_lines(content.decode("utf-8").splitlines())
+            with TextIOWrapper(f, encoding="utf-8", newline="") as lines:
+                self.load_lines(lines)
 
     def load_lines(self, lines):
-        _rates = self._rates = defaultdict(dict)
-        na_values = self.na_values
-        cast = self.cast
-
-        lines = iter(lines)
-        header = next(lines).strip().split(",")[1:]
-
-        for line in lines:
-            line = line.strip().split(",")
-            date = parse_date(line[0])
-            for currency, rate in zip(header, line[1:]):
-                currency = currency.strip()
-                if rate not in na_values and currency:  # skip empty currency
-                    _rates[currency][date] = cast(rate)
-
+        self._parse_lines(lines)
+        self._prepare_rates()
+        self._fill_missing_rates()
+
+    def _parse_lines(self, lines):
+        na_values = set(self.na_values)
+        parse_rate = self._parse_rate
+
+        reader = csv.reader(lines, skipinitialspace=True)
+        header = next(reader)
+        rows = list(reader)
+
+        dates = [parse_date(row[0].strip()) for row in rows]
+        self._epoch = epoch = min(dates)
+        size = 1 + (max(dates) - epoch).days
+        indices = [(date - epoch).days for date in dates]
+
+        # Rates are read column by column, rows being transposed in C
+        columns = islice(zip_longest(*rows), 1, None)
+
+        self._rates = {}
+        self._indices = {}
+        for currency, column in zip(header[1:], columns):
+            # Codes are interned so that comparisons with them are pointer checks
+            currency = sys.intern(currency.strip())
+            if not currency:  # skip empty currency
+                continue
+            rates = [None] * size
+            for i, rate in zip(indices, column):
+                if rate is None:  # omitted trailing rates
+                    continue
+                rate = rate.strip()  # csv.reader only skips leading spaces
+                if rate not in na_values:
+                    rates[i] = parse_rate(rate)
+
+            first_idx = next((i for i, r in enumerate(rates) if r is not None), None)
+            if first_idx is None:  # currencies without any rate are dropped
+                continue
+            last_idx = next(i for i in range(size - 1, -1, -1) if rates[i] is not None)
+            self._rates[currency] = rates
+            self._indices[currency] = first_idx, last_idx
+
+    def _prepare_rates(self):
+        """Compute the available currencies and their bounds from the rates."""
         self.currencies = set(self._rates) | {self.ref_currency}
         self._compute_bounds()
+        # Built once, so batches read the reference rates like any other
+        size = len(next(iter(self._rates.values())))
+        self._ref_rates = [self._one] * size
 
-        for currency in sorted(self._rates):
-            self._set_missing_to_none(currency)
-            if self.fallback_on_missing_rate:
-                method = self.fallback_on_missing_rate_method
-                if method == "linear_interpolation":
-                    self._use_linear_interpolation(currency)
-                elif method == "last_known":
-                    self._use_last_known(currency)
-                else:
-                    raise ValueError(f"Unknown fallback method {method!r}")
+    def _fill_missing_rates(self):
+        """Report missing rates, and mark them to be filled if falling back on
+        missing rates.
+
+        Filling is deferred to the first missing rate hit for each currency,
+        as most uses only need a couple of them.
+        """
+        if self.verbose:
+            for currency in sorted(self._rates):
+                self._report_missing_rates(currency)
+        if self.fallback_on_missing_rate:
+            method = self.fallback_on_missing_rate_method
+            if method not in ("linear_interpolation", "last_known"):
+                raise ValueError(f"Unknown fallback method {method!r}")
+            self._unfilled = set(self._rates)
+
+    def _fill_currency_missing_rates(self, currency):
+        """Fill the missing rates of a currency with the fallback method.
+
+        Rates are filled in a copy which is swapped in at once, so that other
+        threads never read the rates of a currency half filled.
+        """
+        rates = self._rates[currency][:]
+        if self.fallback_on_missing_rate_method == "linear_interpolation":
+            self._use_linear_interpolation(currency, rates)
+        else:
+            self._use_last_known(currency, rates)
+        self._rates[currency] = rates
+        self._unfilled.discard(currency)
 
     def _compute_bounds(self):
+        epoch = self._epoch
+        indices = self._indices
         self.bounds = {
-            currency: Bounds(min(r), max(r)) for currency, r in self._rates.items()
+            currency: Bounds(
+                epoch + timedelta(days=first_idx), epoch + timedelta(days=last_idx)
+            )
+            for currency, (first_idx, last_idx) in indices.items()
         }
 
         self.bounds[self.ref_currency] = Bounds(
-            min(b.first_date for b in self.bounds.values()),
-            max(b.last_date for b in self.bounds.values()),
+            epoch + timedelta(days=min(first_idx for first_idx, _ in indices.values())),
+            epoch + timedelta(days=max(last_idx for _, last_idx in indices.values())),
         )
 
-    def _set_missing_to_none(self, currency):
-        """Fill missing rates of a currency with the closest available ones."""
-        rates = self._rates[currency]
-        first_date, last_date = self.bounds[currency]
-
-        for date in list_dates_between(first_date, last_date):
-            if date not in rates:
-                rates[date] = None
-
-        if self.verbose:
-            missing = len([r for r in rates.values() if r is None])
-            if missing:
-                print(
-                    f"{currency}: {missing} missing rates from {first_date} to {last_date}"
-                    f" ({1 + (last_date - first_date).days} days)"
-                )
+    def _report_missing_rates(self, currency):
+        """Print the number of missing rates of a currency within its bounds."""
+        first_idx, last_idx = self._indices[currency]
+        missing = self._rates[currency][first_idx : last_idx + 1].count(None)
+        if missing:
+            first_date, last_date = self.bounds[currency]
+            print(
+                f"{currency}: {missing} missing rates from {first_date} to {last_date}"
+                f" ({1 + (last_date - first_date).days} days)"
+            )
 
-    def _use_linear_interpolation(self, currency):
+    def _use_linear_interpolation(self, currency, rates):
         """Fill missing rates of a currency.
 
         This is done by linear interpolation of the two closest available rates.
 
         :param str currency: The currency to fill missing rates for.
+        :param list rates: The rates of the currency, filled in place.
         """
-        rates = self._rates[currency]
-
-        # tmp will store the closest rates forward and backward
-        tmp = defaultdict(lambda: [None, None])
+        first_idx, last_idx = self._indices[currency]
 
-        for date in sorted(rates):
-            rate = rates[date]
-            if rate is not None:
-                closest_rate = rate
-                dist = 0
-            else:
-                dist += 1
-                tmp[date][0] = closest_rate, dist
-
-        for date in sorted(rates, reverse=True):
-            rate = rates[date]
-            if rate is not None:
-                closest_rate = rate
-                dist = 0
-            else:
-                dist += 1
-                tmp[date][1] = closest_rate, dist
-
-        for date in sorted(tmp):
-            (r0, d0), (r1, d1) = tmp[date]
-            rates[date] = (r0 * d1 + r1 * d0) / (d0 + d1)
-            if self.verbose:
-                print(
-                    f"{currency}: filling {date} missing rate using"
-                    f" {r0} ({d0}d old) and {r1} ({d1}d later)"
-                )
+        for start, stop in _iter_gaps(rates, first_idx, last_idx):
+            r0, r1 = rates[start - 1], rates[stop]
+            for i in range(start, stop):
+                d0, d1 = i - start + 1, stop - i
+                rates[i] = (r0 * d1 + r1 * d0) / (d0 + d1)
+                if self.verbose:
+                    print(
+                        f"{currency}: filling {self._epoch + timedelta(days=i)} missing"
+                        f" rate using {r0} ({d0}d old) and {r1} ({d1}d later)"
+                    )
 
-    def _use_last_known(self, currency):
+    def _use_last_known(self, currency, rates):
         """Fill missing rates of a currency.
 
         This is done by using the last known rate.
 
         :param str currency: The currency to fill missing rates for.
+        :param list rates: The rates of the currency, filled in place.
         """
-        rates = self._rates[currency]
+        first_idx, last_idx = self._indices[currency]
 
-        for date in sorted(rates):
-            rate = rates[date]
-            if rate is not None:
-                last_rate, last_date = rate, date
-            else:
-                rates[date] = last_rate
-                if self.verbose:
+        for start, stop in _iter_gaps(rates, first_idx, last_idx):
+            last_rate = rates[start - 1]
+            rates[start:stop] = [last_rate] * (stop - start)
+            if self.verbose:
+                last_date = self._epoch + timedelta(days=start - 1)
+                for i in range(start, stop):
                     print(
-                        f"{currency}: filling {date} missing rate using"
-                        f" {last_rate} from {last_date}"
+                        f"{currency}: filling {self._epoch + timedelta(days=i)} missing"
+                        f" rate using {last_rate} from {last_date}"
                     )
 
     def _get_rate(self, currency, date):
@@ -287,9 +421,12 @@ class CurrencyConverter:
         RateNotFoundError: BGN has no rate for 2010-11-21
         """
         if currency == self.ref_currency:
-            return self.cast("1")
+            return self._one
 
-        if date not in self._rates[currency]:
+        i = (date - self._epoch).days
+        first_idx, last_idx = self._indices[currency]
+
+        if not first_idx <= i <= last_idx:
             first_date, last_date = self.bounds[currency]
 
             if not self.fallback_on_wrong_date:
@@ -297,12 +434,10 @@ class CurrencyConverter:
                     f"{date} not in {currency} bounds {first_date}/{last_date}"
                 )
 
-            if date < first_date:
-                fallback_date = first_date
-            elif date > last_date:
-                fallback_date = last_date
+            if i < first_idx:
+                i, fallback_date = first_idx, first_date
             else:
-                raise AssertionError("Should never happen, bug in the code!")
+                i, fallback_date = last_idx, last_date
 
             if self.verbose:
                 print(
@@ -312,7 +447,12 @@ class CurrencyConverter:
 
             date = fallback_date
 
-        rate = self._rates[currency][date]
+        rate = self._rates[currency][i]
+        if rate is None:
+            if currency in self._unfilled:
+                self._fill_currency_missing_rates(currency)
+            # Read again, another thread may have swapped in filled rates
+            rate = self._rates[currency][i]
         if rate is None:
             raise RateNotFoundError(f"{currency} has no rate for {date}")
         return rate
@@ -343,26 +483,119 @@ class CurrencyConverter:
             if c not in self.currencies:
                 raise ValueError(f"{c} is not a supported currency")
 
+        if currency == new_currency:
+            return self.cast(amount)
+
         if date is None:
             date = self.bounds[currency].last_date
-        else:
-            try:
-                date = date.date()  # fallback if input was a datetime object
-            except AttributeError:
-                pass
+        elif isinstance(date, datetime.datetime):
+            date = date.date()
 
-        r0 = self._get_rate(currency, date)
-        r1 = self._get_rate(new_currency, date)
+        # Both rates are read from the same date index
+        i = (date - self._epoch).days
+        r0 = self._read_rate(currency, date, i)
+        r1 = self._read_rate(new_currency, date, i)
 
         return self.cast(amount) / r0 * r1
 
+    def _read_rate(self, currency, date, i):
+        """Get a rate from its date index when available, _get_rate deals
+        with the reference currency, fallbacks and errors otherwise.
+        """
+        if currency != self.ref_currency:
+            first_idx, last_idx = self._indices[currency]
+            if first_idx <= i <= last_idx:
+                rate = self._rates[currency][i]
+                if rate is not None:
+                    return rate
+        return self._get_rate(currency, date)
+
+    def convert_batch(self, amounts, currency, new_currency="EUR", dates=None):
+        """Convert several amounts from a currency to another one.
+
+        This gives the same results as calling `convert` for each amount,
+        but the currencies are checked only once.
+
+        :param amounts: The amounts of `currency` to convert.
+        :param str currency: The currency to convert from.
+        :param str new_currency: The currency to convert to.
+        :param dates: Use the conversion rates of these dates, one per amount.
+            If this is not given, the most recent rate is used for all amounts.
+            A ValueError is raised if there are not as many dates as amounts.
+
+        :return: The values of `amounts` in `new_currency`.
+        :rtype: list
+
+        >>> from datetime import date
+        >>> c = CurrencyConverter()
+        >>> c.convert_batch([100, 10], 'EUR', 'USD',
+        ...                 dates=[date(2014, 3, 28), date(2013, 3, 21)])
+        [137.5..., 12.91...]
+        """
+        for c in currency, new_currency:
+            if c not in self.currencies:
+                raise ValueError(f"{c} is not a supported currency")
+
+        if hasattr(amounts, "__len__") and hasattr(dates, "__len__"):
+            if len(amounts) != len(dates):
+                raise ValueError(f"Got {len(amounts)} amounts but {len(dates)} dates")
+
+        if dates is None:
+            pairs = zip(amounts, repeat(self.bounds[currency].last_date))
+        else:
+            # Iterators are not sized, a fill value shows which one ran out
+            pairs = zip_longest(amounts, dates, fillvalue=_MISSING)
+
+        cast = self.cast
+        if currency == new_currency:
+            results = []
+            for amount, date in pairs:
+                if amount is _MISSING or date is _MISSING:
+                    raise ValueError("Got more amounts than dates, or the reverse")
+                results.append(cast(amount))
+            return results
+
+        # Day ordinals are the same for dates and datetimes, and cheaper to
+        # get than the difference of two dates
+        epoch = self._epoch.toordinal()
+        get_rate = self._get_rate
+        rates0, first0, last0 = self._get_rates_and_indices(currency)
+        rates1, first1, last1 = self._get_rates_and_indices(new_currency)
+
+        results = []
+        for amount, date in pairs:
+            if amount is _MISSING or date is _MISSING:
+                raise ValueError("Got more amounts than dates, or the reverse")
+
+            # Read the rates directly when available, _get_rate deals with
+            # the fallbacks and errors otherwise
+            i = date.toordinal() - epoch
+            r0 = rates0[i] if first0 <= i <= last0 else None
+            r1 = rates1[i] if first1 <= i <= last1 else None
+            if r0 is None or r1 is None:
+                if isinstance(date, datetime.datetime):
+                    date = date.date()
+                if r0 is None:
+                    r0 = get_rate(currency, date)
+                if r1 is None:
+                    r1 = get_rate(new_currency, date)
+
+            results.append(cast(amount) / r0 * r1)
+        return results
+
+    def _get_rates_and_indices(self, currency):
+        """Returns the rates of a currency, with its first and last indexes."""
+        if currency == self.ref_currency:
+            return self._ref_rates, 0, len(self._ref_rates) - 1
+        return (self._rates[currency], *self._indices[currency])
+
 
 class S3CurrencyConverter(CurrencyConverter):
     """
     Load the ECB CSV file from an S3 key instead of from a local file.
     The first argument should be an instance of boto.s3.key.Key (or any other
     object that provides a get_contents_as_string() method which returns the
-    CSV file as a string).
+    CSV file as a string), or a boto3 s3.Object, whose body is streamed.
     """
 
     def __init__(self, currency_file, **kwargs):
@@ -370,5 +603,13 @@ class S3CurrencyConverter(CurrencyConverter):
         super().__init__(currency_file, **kwargs)
 
     def load_file(self, currency_file):
-        lines = currency_file.get_contents_as_string().splitlines()
-        self.load_lines(lines)
+        # Checked first, as a get() method alone does not make a boto3 object
+        if hasattr(currency_file, "get_contents_as_string"):
+            content = currency_file.get_contents_as_string()
+            if isinstance(content, bytes):
+                content = content.decode("utf-8")
+            self.load_lines(content.splitlines())
+        else:  # boto3, stream the body
+            body = currency_file.get()["Body"]
+            lines = body.iter_lines(chunk_size=1 << 16)
+            self.load_lines(line.decode("utf-8") for line in lines)
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 
-from decimal import Decimal
+from decimal import Decimal, localcontext
 from datetime import datetime, date, timedelta
 from io import StringIO
+import pickle
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from pytest import approx
@@ -16,39 +19,70 @@ from currency_converter import (
     SINGLE_DAY_CURRENCY_FILE,
 )
 
-c0 = CurrencyConverter()
-c1 = CurrencyConverter(fallback_on_missing_rate=True)
-c2 = CurrencyConverter(fallback_on_wrong_date=True)
-c3 = CurrencyConverter(
-    fallback_on_missing_rate=True,
-    fallback_on_wrong_date=True,
-    fallback_on_missing_rate_method="linear_interpolation",
-)
-c4 = CurrencyConverter(
-    fallback_on_missing_rate=True,
-    fallback_on_wrong_date=True,
-    fallback_on_missing_rate_method="last_known",
-)
-c5 = CurrencyConverter(CURRENCY_FILE)
 
-converters = [c0, c1, c2, c3, c4, c5]
-converters_with_missing_rate_fallback = [c1, c3, c4]
-converters_with_wrong_date_fallback = [c2, c3, c4]
-converters_without_missing_rate_fallback = [c0, c2, c5]
-converters_without_wrong_date_fallback = [c0, c1, c5]
+# Converters are built once per session, and only if a selected test uses them
+@pytest.fixture(scope="session")
+def c0():
+    return CurrencyConverter()
+
+
+@pytest.fixture(scope="session")
+def c1():
+    return CurrencyConverter(fallback_on_missing_rate=True)
+
+
+@pytest.fixture(scope="session")
+def c2():
+    return CurrencyConverter(fallback_on_wrong_date=True)
+
+
+@pytest.fixture(scope="session")
+def c3():
+    return CurrencyConverter(
+        fallback_on_missing_rate=True,
+        fallback_on_wrong_date=True,
+        fallback_on_missing_rate_method="linear_interpolation",
+    )
+
+
+@pytest.fixture(scope="session")
+def c4():
+    return CurrencyConverter(
+        fallback_on_missing_rate=True,
+        fallback_on_wrong_date=True,
+        fallback_on_missing_rate_method="last_known",
+    )
+
+
+@pytest.fixture(scope="session")
+def c5():
+    return CurrencyConverter(CURRENCY_FILE)
 
 
 @pytest.fixture
-def fallback_with_linear_interpolation():
+def c(request):
+    """The converter fixture named by the indirect parameter."""
+    return request.getfixturevalue(request.param)
+
+
+converters = ["c0", "c1", "c2", "c3", "c4", "c5"]
+converters_with_missing_rate_fallback = ["c1", "c3", "c4"]
+converters_with_wrong_date_fallback = ["c2", "c3", "c4"]
+converters_without_missing_rate_fallback = ["c0", "c2", "c5"]
+converters_without_wrong_date_fallback = ["c0", "c1", "c5"]
+
+
+@pytest.fixture
+def fallback_with_linear_interpolation(c3):
     return c3
 
 
 @pytest.fixture
-def fallback_with_last_known():
+def fallback_with_last_known(c4):
     return c4
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def decimal_converter():
     return CurrencyConverter(decimal=True)
 
@@ -134,23 +168,47 @@ SINGLE_DAY_CURRENCIES = {
 
 
 class TestRates:
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_convert(self, c):
         assert c.convert(10, "EUR", "USD", date(2013, 3, 21)) == approx(12.91)
         assert c.convert(10, "EUR", "USD", date(2014, 3, 28)) == approx(13.758999)
         assert c.convert(10, "USD", "EUR", date(2014, 3, 28)) == approx(7.26797)
 
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_convert_with_datetime(self, c):
         assert c.convert(10, "EUR", "USD", datetime(2013, 3, 21)) == approx(12.91)
         assert c.convert(10, "EUR", "USD", datetime(2014, 3, 28)) == approx(13.758999)
         assert c.convert(10, "USD", "EUR", datetime(2014, 3, 28)) == approx(7.26797)
 
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_convert_to_ref_currency(self, c):
         assert c.convert(10, "EUR") == 10.0
         assert c.convert(10, "EUR", "EUR") == 10.0
 
+    @pytest.mark.parametrize("c", converters, indirect=True)
+    def test_convert_batch(self, c):
+        dates = [date(2013, 3, 21), datetime(2014, 3, 28)]
+        assert c.convert_batch([10, 10], "EUR", "USD", dates) == approx(
+            [12.91, 13.758999]
+        )
+        assert c.convert_batch([10, 20], "EUR") == [10.0, 20.0]
+
+    def test_convert_batch_ref_currency(self, c0, decimal_converter):
+        dates = [date(2014, 3, 28)] * 3
+        assert c0.convert_batch([10] * 3, "EUR", "USD", dates) == approx([13.759] * 3)
+        assert c0.convert_batch([10] * 3, "USD", "EUR", dates) == approx([7.26797] * 3)
+        assert decimal_converter.convert_batch([10], "EUR", "USD", dates[:1]) == [
+            Decimal("13.7590")
+        ]
+        # The reference rates are shared by batches, not built for each one
+        rates, _, _ = c0._get_rates_and_indices("EUR")
+        assert rates is c0._get_rates_and_indices("EUR")[0]
+
+    @pytest.mark.parametrize("c", converters, indirect=True)
+    def test_convert_to_same_currency(self, c):
+        assert c.convert(10.1, "USD", "USD", date(2014, 3, 28)) == 10.1
+        assert c.convert_batch([10.1], "USD", "USD", [date(2014, 3, 28)]) == [10.1]
+
     def test_decimal_converter(self, decimal_converter):
         dc = decimal_converter
         assert dc.convert(10, "EUR", "USD", date(2013, 3, 21)) == Decimal("12.910")
@@ -160,32 +218,61 @@ class TestRates:
         )
         assert dc.convert(10, "EUR") == Decimal(10)
         assert dc.convert(10, "EUR", "EUR") == Decimal(10)
+        # Amounts are parsed like Decimal does, surrounding spaces included
+        assert dc.convert(" 10 ", "EUR", "USD", date(2014, 3, 28)) == Decimal("13.7590")
+        assert dc.convert_batch([" 10 "], "EUR") == [Decimal(10)]
 
 
 class TestErrorCases:
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_wrong_currency(self, c):
         with pytest.raises(ValueError):
             c.convert(1, "AAA")
 
-    @pytest.mark.parametrize("c", converters_without_missing_rate_fallback)
+    @pytest.mark.parametrize(
+        "c", converters_without_missing_rate_fallback, indirect=True
+    )
     def test_convert_with_missing_rate(self, c):
         with pytest.raises(RateNotFoundError):
             c.convert(10, "BGN", date=date(2010, 11, 21))
 
-    @pytest.mark.parametrize("c", converters_with_missing_rate_fallback)
+    @pytest.mark.parametrize("c", converters_with_missing_rate_fallback, indirect=True)
     def test_convert_fallback_on_missing_rate(self, c):
-        assert c1.convert(10, "BGN", date=date(2010, 11, 21)) == approx(5.112997238)
+        assert c.convert(10, "BGN", date=date(2010, 11, 21)) == approx(5.112997238)
 
-    @pytest.mark.parametrize("c", converters_without_wrong_date_fallback)
+    @pytest.mark.parametrize("c", converters_without_wrong_date_fallback, indirect=True)
     def test_convert_with_wrong_date(self, c):
         with pytest.raises(RateNotFoundError):
             c.convert(10, "EUR", "USD", date=date(1986, 2, 2))
 
-    @pytest.mark.parametrize("c", converters_with_wrong_date_fallback)
+    @pytest.mark.parametrize("c", converters_with_wrong_date_fallback, indirect=True)
     def test_convert_fallback_on_wrong_date(self, c):
         assert c.convert(10, "EUR", "USD", date=date(1986, 2, 2)) == approx(11.789)
 
+    def test_convert_batch_fallbacks(self, c0, c3):
+        dates = [date(1986, 2, 2), date(2010, 11, 21)]
+        assert c3.convert_batch([10, 10], "EUR", "BGN", dates) == approx(
+            [19.469, 19.558]
+        )
+        with pytest.raises(RateNotFoundError):
+            c0.convert_batch([10, 10], "EUR", "BGN", dates)
+
+    def test_convert_batch_length_mismatch(self, c0):
+        with pytest.raises(ValueError):
+            c0.convert_batch([10, 20, 30], "USD", "JPY", [date(2014, 3, 28)])
+        with pytest.raises(ValueError):
+            c0.convert_batch([10, 20], "USD", "USD", [date(2014, 3, 28)])
+        dates = [date(2014, 3, 28)]
+        with pytest.raises(ValueError):
+            c0.convert_batch(iter([10, 20]), "USD", "JPY", iter(dates))
+        with pytest.raises(ValueError):
+            c0.convert_batch(iter([10]), "USD", "JPY", iter(dates * 2))
+        with pytest.raises(ValueError):
+            c0.convert_batch(iter([10, 20]), "USD", "USD", iter(dates))
+        assert c0.convert_batch(iter([10]), "EUR", "USD", iter(dates)) == approx(
+            [13.759]
+        )
+
     def test_fallback_methds(
         self, fallback_with_linear_interpolation, fallback_with_last_known
     ):
@@ -200,7 +287,7 @@ def last_n_days(n):
 
 
 class TestAttributes:
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_bounds(self, c):
         assert c.bounds["USD"][0] == date(1999, 1, 4)
         assert c.bounds["BGN"][0] == date(2000, 7, 19)
@@ -210,13 +297,14 @@ class TestAttributes:
         assert c.bounds["BGN"][1] in last_n_days(7)
         assert c.bounds["EUR"][1] in last_n_days(7)
 
-    @pytest.mark.parametrize("c", converters)
+    @pytest.mark.parametrize("c", converters, indirect=True)
     def test_currencies(self, c):
         assert "EUR" in c.currencies
         assert c.currencies == HISTORY_CURRENCIES
 
 
-class TestCustomObject:
+@pytest.fixture(scope="module")
+def custom_converter():
     c = CurrencyConverter(
         currency_file=None, fallback_on_wrong_date=True, fallback_on_missing_rate=True
     )
@@ -231,58 +319,107 @@ class TestCustomObject:
     2014-03-22,N/A,0"""
         )
     )
+    return c
+
 
-    def test_convert(self):
-        assert self.c.convert(10, "EUR", "USD") == approx(20)
-        assert self.c.convert(10, "USD", "EUR") == approx(5)
+class TestCustomObject:
+    def test_convert(self, custom_converter):
+        c = custom_converter
+        assert c.convert(10, "EUR", "USD") == approx(20)
+        assert c.convert(10, "USD", "EUR") == approx(5)
 
-    def test_fallback_date(self):
+    def test_fallback_date(self, custom_converter):
+        c = custom_converter
         # Fallback to 2014-03-29 rate of 2
-        assert self.c.convert(10, "EUR", "USD", date(2015, 1, 1)) == approx(20)
-        assert self.c.convert(10, "USD", "EUR", date(2015, 1, 1)) == approx(5)
+        assert c.convert(10, "EUR", "USD", date(2015, 1, 1)) == approx(20)
+        assert c.convert(10, "USD", "EUR", date(2015, 1, 1)) == approx(5)
 
         # Fallback to 2014-03-23 rate of 18
-        assert self.c.convert(10, "EUR", "USD", date(2012, 1, 1)) == approx(180)
-        assert self.c.convert(10, "USD", "EUR", date(2012, 1, 1)) == approx(0.55555555)
+        assert c.convert(10, "EUR", "USD", date(2012, 1, 1)) == approx(180)
+        assert c.convert(10, "USD", "EUR", date(2012, 1, 1)) == approx(0.55555555)
 
-    def test_fallback_rate(self):
+    def test_fallback_rate(self, custom_converter):
+        c = custom_converter
         # Fallback rate is the average between 2 and 6, so 4
-        assert self.c.convert(10, "EUR", "USD", date(2014, 3, 28)) == approx(40)
-        assert self.c.convert(10, "USD", "EUR", date(2014, 3, 28)) == approx(2.5)
+        assert c.convert(10, "EUR", "USD", date(2014, 3, 28)) == approx(40)
+        assert c.convert(10, "USD", "EUR", date(2014, 3, 28)) == approx(2.5)
 
         # Fallback rate is the weighted mean between 6 (d:1) and 18 (d:3), so 9
-        assert self.c.convert(10, "EUR", "USD", date(2014, 3, 26)) == approx(90)
-        assert self.c.convert(10, "USD", "EUR", date(2014, 3, 26)) == approx(1.11111111)
+        assert c.convert(10, "EUR", "USD", date(2014, 3, 26)) == approx(90)
+        assert c.convert(10, "USD", "EUR", date(2014, 3, 26)) == approx(1.11111111)
 
-    def test_attributes(self):
-        assert self.c.currencies == {"EUR", "USD", "AAA"}
-        assert self.c.bounds == {
+    def test_attributes(self, custom_converter):
+        c = custom_converter
+        assert c.currencies == {"EUR", "USD", "AAA"}
+        assert c.bounds == {
             "USD": (date(2014, 3, 23), date(2014, 3, 29)),
             "AAA": (date(2014, 3, 22), date(2014, 3, 27)),
             # Max of previous ranges
             "EUR": (date(2014, 3, 22), date(2014, 3, 29)),
         }
 
+    def test_padded_values(self):
+        c = CurrencyConverter(currency_file=None)
+        c.load_lines(StringIO("Date,USD,JPY\n2014-03-28,1.3 ,N/A \n"))
+        assert c.currencies == {"EUR", "USD"}
+        assert c.convert(10, "EUR", "USD", date(2014, 3, 28)) == approx(13)
+
+    def test_ref_currency_column(self):
+        # A column for the reference currency is ignored, its rate is 1
+        c = CurrencyConverter(currency_file=None, ref_currency="USD")
+        c.load_lines(StringIO("Date,USD,JPY,\n2014-03-28,1.3759,140.9,\n"))
+        assert c.convert(10, "USD", "JPY") == approx(1409)
+        assert c.convert_batch([10], "USD", "JPY") == approx([1409])
+
+    def test_padded_decimal_values(self):
+        c = CurrencyConverter(currency_file=None, decimal=True)
+        c.load_lines(StringIO("Date,USD,JPY,\n2014-03-28, 1.3759 , 140.9 ,\n"))
+        assert c.convert(10, "EUR", "USD") == Decimal("13.7590")
+        assert c.convert(10, "EUR", "JPY") == Decimal("1409.0")
+
+
+def test_concurrent_missing_rate_fallback():
+    # Missing rates are filled on first use, threads hitting them at the same
+    # time must all see filled rates
+    lines = ["Date,USD,", "2014-03-28,2,", "2000-01-01,1,"]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for _ in range(10):
+            c = CurrencyConverter(currency_file=None, fallback_on_missing_rate=True)
+            c.load_lines(lines)
+            with ThreadPoolExecutor(8) as executor:
+                futures = [
+                    executor.submit(c.convert, 10, "USD", "EUR", date(2010, 1, 1))
+                    for _ in range(8)
+                ]
+                for future in futures:
+                    assert future.result() == approx(5.87372)
+    finally:
+        sys.setswitchinterval(switch_interval)
+
 
 @pytest.mark.parametrize(
-    "c",
+    "currency_file",
     [
-        CurrencyConverter(SINGLE_DAY_ECB_URL),
-        CurrencyConverter(SINGLE_DAY_CURRENCY_FILE),
+        pytest.param(SINGLE_DAY_ECB_URL, marks=pytest.mark.network),
+        SINGLE_DAY_CURRENCY_FILE,
     ],
 )
-def test_single_day_sources(c):
+def test_single_day_sources(currency_file):
+    c = CurrencyConverter(currency_file)
     assert c.currencies == SINGLE_DAY_CURRENCIES
     assert c.bounds["USD"][0] == c.bounds["USD"][1]
     assert c.bounds["USD"][0] in last_n_days(7)
 
 
 class TestCustomSource:
-    def test_local_zip_file(self):
-        c = CurrencyConverter(CURRENCY_FILE)
+    def test_local_zip_file(self, c5):
+        c = c5  # built from CURRENCY_FILE
         assert c.currencies == HISTORY_CURRENCIES
         assert c.convert(10, "EUR", "USD", date(2013, 3, 21)) == approx(12.91)
 
+    @pytest.mark.network
     def test_remote_zip_file(self):
         c = CurrencyConverter(ECB_URL)
         assert c.currencies == HISTORY_CURRENCIES
@@ -292,6 +429,7 @@ class TestCustomSource:
         c = CurrencyConverter(SINGLE_DAY_CURRENCY_FILE)
         assert c.currencies == SINGLE_DAY_CURRENCIES
 
+    @pytest.mark.network
     def test_remote_clear_file(self):
         c = CurrencyConverter(
             "https://raw.githubusercontent.com/alexprengere"
@@ -300,6 +438,71 @@ class TestCustomSource:
         assert c.currencies == SINGLE_DAY_CURRENCIES
 
 
+@pytest.fixture
+def currency_file(tmp_path):
+    """A small currency file, in a directory of its own."""
+    currency_file = tmp_path / "rates.csv"
+    currency_file.write_text("Date,USD,\n2014-03-28,1.3759,\n")
+    return currency_file
+
+
+class TestCache:
+    def test_cache_file(self, tmp_path, currency_file):
+        c = CurrencyConverter(str(currency_file), cache=True)
+        assert (tmp_path / "rates.csv.pickle").exists()
+        assert c.convert(10, "EUR", "USD") == approx(13.759)
+
+        c = CurrencyConverter(str(currency_file), cache=True)
+        assert c.currencies == {"EUR", "USD"}
+        assert c.convert(10, "EUR", "USD") == approx(13.759)
+
+    def test_cache_invalidation(self, currency_file):
+        CurrencyConverter(str(currency_file), cache=True)
+
+        currency_file.write_text("Date,USD,\n2014-03-28,1.5,\n")
+        c = CurrencyConverter(str(currency_file), cache=True)
+        assert c.convert(10, "EUR", "USD") == approx(15)
+
+        c = CurrencyConverter(str(currency_file), cache=True, decimal=True)
+        assert c.convert(10, "EUR", "USD") == Decimal("15.0")
+
+    def test_cache_fallback_on_missing_rate(self, currency_file):
+        currency_file.write_text("Date,USD,\n2014-03-28,1.5,\n2014-03-26,1.3,\n")
+        c = CurrencyConverter(str(currency_file), cache=True)
+        with pytest.raises(RateNotFoundError):
+            c.convert(10, "EUR", "USD", date=date(2014, 3, 27))
+
+        c = CurrencyConverter(
+            str(currency_file), cache=True, fallback_on_missing_rate=True
+        )
+        assert c.convert(10, "EUR", "USD", date=date(2014, 3, 27)) == approx(14)
+
+    def test_cache_decimal_context(self, currency_file):
+        with localcontext() as context:
+            context.prec = 2
+            c = CurrencyConverter(str(currency_file), cache=True, decimal=True)
+            assert c.convert(1, "EUR", "USD") == Decimal("1.4")
+
+        c = CurrencyConverter(str(currency_file), cache=True, decimal=True)
+        assert c.convert(1, "EUR", "USD") == Decimal("1.3759")
+
+    def test_cache_foreign_file(self, tmp_path, currency_file):
+        (tmp_path / "rates.csv.pickle").write_bytes(pickle.dumps(42))
+
+        c = CurrencyConverter(str(currency_file), cache=True)
+        assert c.convert(10, "EUR", "USD") == approx(13.759)
+
+    def test_cache_write_failure(self, tmp_path, currency_file, monkeypatch):
+        def replace(src, dst):
+            raise PermissionError(dst)
+
+        monkeypatch.setattr("os.replace", replace)
+        with pytest.warns(UserWarning, match="Could not write cache file"):
+            c = CurrencyConverter(str(currency_file), cache=True)
+        assert c.convert(10, "EUR", "USD") == approx(13.759)
+        assert [p.name for p in tmp_path.iterdir()] == ["rates.csv"]
+
+
 class TestS3:
     def test_S3_currency_file_required(self):
         with pytest.raises(TypeError):
@@ -308,3 +511,23 @@ class TestS3:
     def test_S3_currency_file_needs_get_contents_as_strings(self):
         with pytest.raises(AttributeError):
             S3CurrencyConverter("simple_string")
+
+    def test_S3_streams_boto3_object_body(self):
+        class Body:
+            def iter_lines(self, chunk_size):
+                yield from [b"Date,USD,", b"2014-03-28,1.3759,"]
+
+        class Object:
+            def get(self):
+                return {"Body": Body()}
+
+        c = S3CurrencyConverter(Object())
+        assert c.convert(10, "EUR", "USD") == approx(13.759)
+
+    def test_S3_prefers_get_contents_as_string(self):
+        class Key(dict):
+            def get_contents_as_string(self):
+                return b"Date,USD,\n2014-03-28,1.3759,\n"
+
+        c = S3CurrencyConverter(Key())
+        assert c.convert(10, "EUR", "USD") == approx(13.759)